@@ -1,8 +1,13 @@
-from curl_cffi import requests
+from curl_cffi.requests import AsyncSession
+from typing import Any
+import msgspec
 import pandas as pd
-import time
+import numpy as np
+import asyncio
 import random
+import re
 from datetime import datetime
+from common import save_csv, compute_discount
 
 # --- CONFIG ---
 CATEGORIES = {
@@ -34,97 +39,194 @@ CATEGORIES = {
     }
     
 BLACKLIST_KEYWORDS = ['baby', 'kind', 'huisdier', 'dier']
+BLACKLIST_RE = re.compile('|'.join(map(re.escape, BLACKLIST_KEYWORDS)))
 
-def scrape_ah_final():
+HEADERS = {
+    'Host': 'www.ah.nl',
+    'accept': 'application/json',
+    'referer': 'https://www.ah.nl/producten',
+    'x-requested-with': 'XMLHttpRequest'
+}
+BASE_URL = "https://www.ah.nl/zoeken/api/products/search"
+PAGE_SIZE = 36
+MAX_CONCURRENCY = 16 # Parallel requests against ah.nl
+MAX_RETRIES = 4
+
+# --- RESPONSE SCHEMA (only the fields we read; everything else is skipped while decoding) ---
+# gc=False: decoded trees never form cycles, so the GC doesn't need to track thousands of them
+class AHPrice(msgspec.Struct, gc=False):
+    now: float | None = None
+    was: float | None = None
+    unitSize: str | None = None
+
+class AHShield(msgspec.Struct, gc=False):
+    text: str | None = None
+
+class AHProperties(msgspec.Struct, gc=False):
+    nutriscore: str | None = None
+
+class AHProduct(msgspec.Struct, gc=False):
+    id: int | str | None = None
+    title: str | None = None
+    category: str | None = None
+    price: AHPrice | None = None
+    shield: AHShield | None = None
+    discount: Any = None
+    properties: AHProperties | None = None
+    link: str | None = None
+
+# Every field accepts null: one odd product must not fail the decode of the whole page
+class AHCard(msgspec.Struct, gc=False):
+    products: list[AHProduct] | None = None
+
+class AHPage(msgspec.Struct, gc=False):
+    totalPages: int | None = None
+
+class AHSearchResponse(msgspec.Struct, gc=False):
+    cards: list[AHCard] | None = None
+    page: AHPage | None = None
+
+# Shared stand-ins for missing nested objects
+NO_PRICE = AHPrice()
+NO_SHIELD = AHShield()
+NO_PROPERTIES = AHProperties()
+
+async def fetch_page(session, semaphore, tax_id, page):
+    """
+    Fetches one search page, backing off exponentially on rate limits / server errors.
+    """
+    params = {'taxonomy': tax_id, 'size': PAGE_SIZE, 'page': page}
+    async with semaphore:
+        for attempt in range(MAX_RETRIES):
+            await asyncio.sleep(random.uniform(0.6, 1.2))
+            try:
+                resp = await session.get(BASE_URL, params=params, timeout=15)
+            except Exception:
+                resp = None
+
+            if resp is not None:
+                if resp.status_code == 200:
+                    try:
+                        return msgspec.json.decode(resp.content, type=AHSearchResponse)
+                    except msgspec.ValidationError as e:
+                        # Valid JSON in an unexpected shape won't change on retry
+                        print(f"   ⚠️ Unexpected response for {tax_id} page {page}: {e}")
+                        return None
+                    except msgspec.DecodeError as e:
+                        # Empty/truncated body or an HTML bot-check page: retry like a server error
+                        print(f"   ⚠️ Malformed response for {tax_id} page {page}: {e}")
+                # Anything other than throttling / server trouble won't fix itself
+                elif resp.status_code != 429 and resp.status_code < 500: return None
+
+            # No point backing off (and holding a semaphore slot) after the last attempt
+            if attempt == MAX_RETRIES - 1: break
+            # Respect the server's Retry-After hint, otherwise 1s, 2s, 4s...
+            retry_after = resp.headers.get('Retry-After', '') if resp is not None else ''
+            delay = float(retry_after) if retry_after.isdigit() else 2 ** attempt
+            await asyncio.sleep(delay)
+    return None
+
+EXPORT_COLUMNS = [
+    "id", "title", "scraped_aisle", "category_specific", "final_price", "original_price",
+    "unit", "discount", "nutriscore", "url", "scraped_at"
+]
+
+def parse_products(data, slug, current_date, cols):
+    """
+    Appends every product on a search page straight into the column lists in `cols`.
+    Returns the number of products added.
+    """
+    count = 0
+    appends = [cols[col].append for col in EXPORT_COLUMNS]
+    for card in data.cards or ():
+        for p in card.products or ():
+            price = p.price or NO_PRICE
+            original_price = price.was if price.was else price.now
+            discount = (p.shield or NO_SHIELD).text or ""
+            if not discount and p.discount: discount = "Bonus"
+
+            values = (
+                p.id, p.title, slug, p.category, price.now, original_price,
+                price.unitSize, discount, (p.properties or NO_PROPERTIES).nutriscore,
+                f"https://www.ah.nl{p.link or ''}", current_date
+            )
+            for append, value in zip(appends, values):
+                append(value)
+            count += 1
+    return count
+
+async def scrape_ah_async():
     print("🚀 Initializing AH Session...")
-    session = requests.Session(impersonate="chrome110")
-    session.headers.update({
-        'Host': 'www.ah.nl',
-        'accept': 'application/json',
-        'referer': 'https://www.ah.nl/producten',
-        'x-requested-with': 'XMLHttpRequest'
-    })
-
-    base_url = "https://www.ah.nl/zoeken/api/products/search"
-    master_data = []
+    cols = {col: [] for col in EXPORT_COLUMNS}
     current_date = datetime.now().strftime("%Y-%m-%d")
     date_clean = datetime.now().strftime("%Y%m%d")
 
-    ACTIVE_CATS = {k: v for k, v in CATEGORIES.items() if not any(b in k for b in BLACKLIST_KEYWORDS)}
+    ACTIVE_CATS = {k: v for k, v in CATEGORIES.items() if not BLACKLIST_RE.search(k)}
     print(f"\n🚜 Starting Scrape of {len(ACTIVE_CATS)} Official Root Categories...")
 
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    async with AsyncSession(impersonate="chrome110", headers=HEADERS, max_clients=MAX_CONCURRENCY) as session:
+        # 1. First page of every category tells us how many pages it has
+        first_pages = await asyncio.gather(*[fetch_page(session, semaphore, tax_id, 0) for tax_id in ACTIVE_CATS.values()])
+
+        pages_by_slug = {}
+        tasks = []
+        for (slug, tax_id), data in zip(ACTIVE_CATS.items(), first_pages):
+            if data is None:
+                pages_by_slug[slug] = []
+                continue
+            pages_by_slug[slug] = [data]
+            total_pages = (data.page.totalPages if data.page else None) or 1
+            tasks.extend((slug, tax_id, page) for page in range(1, total_pages))
+
+        # 2. All remaining (category, page) requests at once
+        print(f"   ⏳ Fetching {len(tasks)} more pages ({MAX_CONCURRENCY} at a time)...")
+        results = await asyncio.gather(*[fetch_page(session, semaphore, tax_id, page) for _, tax_id, page in tasks])
+
+    for (slug, _, _), data in zip(tasks, results):
+        if data is not None: pages_by_slug[slug].append(data)
+
+    # Keep category order so the first aisle seen per product stays stable
     for slug, tax_id in ACTIVE_CATS.items():
-        print(f"\n   📂 {slug} (ID: {tax_id})")
-        page = 0
-        total_pages = 1
         products_collected = 0
-        
-        while page < total_pages:
-            params = {'taxonomy': tax_id, 'size': 36, 'page': page}
-            try:
-                resp = session.get(base_url, params=params, timeout=15)
-                if resp.status_code != 200: break
-                
-                data = resp.json()
-                if page == 0: total_pages = data.get('page', {}).get('totalPages', 1)
-
-                cards = data.get('cards', [])
-                for card in cards:
-                    for p in card.get('products', []):
-                        try:
-                            price_obj = p.get('price', {})
-                            final_price = price_obj.get('now')
-                            was_price = price_obj.get('was')
-                            original_price = was_price if was_price else final_price
-                            discount = p.get('shield', {}).get('text', "")
-                            if not discount and p.get('discount'): discount = "Bonus"
-
-                            item = {
-                                "id": p.get('id'),
-                                "title": p.get('title'),
-                                "scraped_aisle": slug,
-                                "category_specific": p.get('category'),
-                                "final_price": final_price,
-                                "original_price": original_price,
-                                "unit": price_obj.get('unitSize'),
-                                "discount": discount,
-                                "nutriscore": p.get('properties', {}).get('nutriscore'),
-                                "url": f"https://www.ah.nl{p.get('link', '')}",
-                                "scraped_at": current_date
-                            }
-                            master_data.append(item)
-                            products_collected += 1
-                        except: continue
-                page += 1
-                time.sleep(random.uniform(0.6, 1.2))
-            except Exception: break
-        print(f"      ✅ Found {products_collected} items.")
-        time.sleep(2)
-
-    if master_data:
+        for data in pages_by_slug[slug]:
+            products_collected += parse_products(data, slug, current_date, cols)
+        print(f"   📂 {slug} (ID: {tax_id}): ✅ Found {products_collected} items.")
+
+    if cols['id']:
         print(f"\n📊 Processing AH Data...")
-        df = pd.DataFrame(master_data)
+        # Column-wise build: one pass per column instead of row-wise dict inference
+        # Prices go in as typed float arrays (None -> NaN), so discount math is one vectorized pass
+        final_price = np.array(cols['final_price'], dtype=np.float64)
+        original_price = np.array(cols['original_price'], dtype=np.float64)
+        df = pd.DataFrame({**cols, 'final_price': final_price, 'original_price': original_price})
+        df.insert(df.columns.get_loc('original_price') + 1, 'discount_percent', compute_discount(final_price, original_price))
         
         # 1. Summary
         summary_df = df.groupby(['scraped_aisle']).size().reset_index(name='items_found')
         summary_filename = f"ah_summary1_{date_clean}.csv"
-        summary_df.to_csv(summary_filename, index=False)
+        save_csv(summary_df, summary_filename)
         print(f"   📄 Summary saved: {summary_filename}")
 
         # 2. Overlaps
-        aisle_map = df.groupby('id')['scraped_aisle'].apply(lambda x: '; '.join(sorted(set(x)))).reset_index()
-        aisle_map.rename(columns={'scraped_aisle': 'all_aisles'}, inplace=True)
+        # Dedup + sort up front so the groupby only has to join (no per-group Python lambda)
+        pairs = df[['id', 'scraped_aisle']].drop_duplicates()
+        pairs.sort_values(['id', 'scraped_aisle'], inplace=True)
+        aisle_map = pairs.groupby('id', sort=False)['scraped_aisle'].agg('; '.join).reset_index(name='all_aisles')
         df = df.merge(aisle_map, on='id', how='left')
         
         # 3. Unique Export
         df_unique = df.drop_duplicates(subset=['id'])
         export_filename = f"ah_full_export1_{date_clean}.csv"
-        df_unique.to_csv(export_filename, index=False)
+        save_csv(df_unique, export_filename)
         print(f"   💾 Export saved: {export_filename}")
         
         return export_filename, summary_filename
     else:
         return None, None
 
+def scrape_ah_final():
+    return asyncio.run(scrape_ah_async())
+
 if __name__ == "__main__":
     scrape_ah_final()
\ No newline at end of file
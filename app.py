@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import time
 import plotly.express as px
 import google.generativeai as genai
 from streamlit_gsheets import GSheetsConnection
@@ -28,18 +29,65 @@ def load_data():
     # Convert Date to datetime
     df['date'] = pd.to_datetime(df['date'], dayfirst=True, errors='coerce')
     
-    return df
+    # Changes on every reload, so caches built from this frame can key on it
+    loaded_at = time.time()
+    return df, loaded_at
+
+# Aggregates are built once per data load. The frame itself isn't hashed (leading underscore);
+# the cache is keyed on its load time instead, so it refreshes exactly when load_data() does.
+@st.cache_data(max_entries=1)
+def load_aggregates(_df, loaded_at):
+    by_date = _df.groupby('date', sort=True)['Total'].sum()
+    by_product = _df.groupby('product_english')[['Total', 'quantity']].sum()
+    by_product_date = _df.groupby(['product_english', 'date'], sort=True)['Total'].sum()
+    return by_date, by_product, by_product_date
+
+# The views below are cheap slices of those aggregates and stay uncached,
+# so KPIs, plots and the sidebar always come from the same data load.
+def kpi_metrics(aggregates):
+    by_date, by_product, _ = aggregates
+    today = pd.Timestamp.now()
+    last_week = today - pd.Timedelta(days=7)
+    last_month = today - pd.Timedelta(days=30)
+
+    # Sorted DatetimeIndex -> slicing instead of a boolean mask over every row
+    recent_spend = by_date.loc[last_week:].sum()
+    monthly_spend = by_date.loc[last_month:].sum()
+    top_item = by_product['quantity'].idxmax() if not by_product.empty else "N/A"
+    return recent_spend, monthly_spend, top_item
+
+def daily_spend(aggregates, products):
+    by_date, _, by_product_date = aggregates
+    if products:
+        selected = by_product_date[by_product_date.index.get_level_values('product_english').isin(products)]
+        by_date = selected.groupby(level='date').sum()
+    return by_date.reset_index()
+
+def top_products(aggregates, products):
+    _, by_product, _ = aggregates
+    totals = by_product['Total']
+    if products:
+        totals = totals[totals.index.isin(products)]
+    return totals.nlargest(10).reset_index()
+
+# Same keying as load_aggregates: built once per data load, not on every chat message
+@st.cache_data(max_entries=1)
+def make_csv_context(_df, loaded_at):
+    # Limit to last 100 rows to save tokens if data gets huge
+    return _df.tail(100).to_csv(index=False)
+
+@st.cache_resource
+def get_gemini_model():
+    # Configured once per server process instead of on every chat message
+    genai.configure(api_key=st.secrets["gemini"]["api_key"])
+    return genai.GenerativeModel('gemini-2.5-flash')
 
 try:
-    df = load_data()
+    df, loaded_at = load_data()
+    aggregates = load_aggregates(df, loaded_at)
     # Sidebar Filters
     st.sidebar.header("Filters")
     selected_product = st.sidebar.multiselect("Select Product", df['product_english'].unique())
-    
-    if selected_product:
-        df_filtered = df[df['product_english'].isin(selected_product)]
-    else:
-        df_filtered = df
 
 except Exception as e:
     st.error(f"Error loading data: {e}")
@@ -53,14 +101,7 @@ with tab1:
     # KPI Metrics
     col1, col2, col3 = st.columns(3)
     
-    # Calculate Date Ranges
-    today = pd.Timestamp.now()
-    last_week = today - pd.Timedelta(days=7)
-    last_month = today - pd.Timedelta(days=30)
-
-    recent_spend = df[df['date'] >= last_week]['Total'].sum()
-    monthly_spend = df[df['date'] >= last_month]['Total'].sum()
-    top_item = df.groupby('product_english')['quantity'].sum().idxmax() if not df.empty else "N/A"
+    recent_spend, monthly_spend, top_item = kpi_metrics(aggregates)
 
     col1.metric("Spent Last 7 Days", f"€{recent_spend:.2f}")
     col2.metric("Spent Last 30 Days", f"€{monthly_spend:.2f}")
@@ -73,16 +114,13 @@ with tab1:
     
     with c1:
         st.subheader("Spending Over Time")
-        # Group by Date
-        daily_spend = df_filtered.groupby('date')['Total'].sum().reset_index()
-        fig_line = px.line(daily_spend, x='date', y='Total', markers=True, title="Daily Spending Trend")
+        fig_line = px.line(daily_spend(aggregates, selected_product), x='date', y='Total', markers=True, title="Daily Spending Trend")
         st.plotly_chart(fig_line, use_container_width=True)
 
     with c2:
         st.subheader("Top Products by Cost")
         # Top 10 expensive items
-        top_products = df_filtered.groupby('product_english')['Total'].sum().nlargest(10).reset_index()
-        fig_bar = px.bar(top_products, x='Total', y='product_english', orientation='h', title="Top 10 Most Expensive Items")
+        fig_bar = px.bar(top_products(aggregates, selected_product), x='Total', y='product_english', orientation='h', title="Top 10 Most Expensive Items")
         st.plotly_chart(fig_bar, use_container_width=True)
 
 # --- TAB 2: AI CHATBOT (RAG) ---
@@ -107,8 +145,7 @@ with tab2:
 
         # 2. Prepare Context (The "RAG" part)
         # We convert the dataframe to CSV string so Gemini can read it
-        # Limit to last 100 rows to save tokens if data gets huge
-        csv_context = df.tail(100).to_csv(index=False)
+        csv_context = make_csv_context(df, loaded_at)
         
         system_prompt = f"""
         You are a helpful household data assistant. 
@@ -124,8 +161,7 @@ with tab2:
 
         # 3. Call Gemini
         try:
-            genai.configure(api_key=st.secrets["gemini"]["api_key"])
-            model = genai.GenerativeModel('gemini-2.5-flash')
+            model = get_gemini_model()
             
             response = model.generate_content([system_prompt, prompt])
             bot_reply = response.text
@@ -0,0 +1,22 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+# Helpers shared by the scrapers and the translation step
+
+def save_csv(df, path):
+    """
+    Writes a DataFrame to CSV with pyarrow's C writer, falling back to pandas for mixed-type columns.
+    """
+    try:
+        pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), path)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df.to_csv(path, index=False)
+
+def compute_discount(final_price, original_price):
+    """
+    Whole-percent discount per product from float price arrays (0 where there is none or a price is missing).
+    """
+    has_discount = (original_price > 0) & (original_price != final_price) & ~np.isnan(final_price)
+    safe_original = np.where(has_discount, original_price, 1.0)
+    return np.where(has_discount, np.round(100 * (original_price - final_price) / safe_original), 0).astype(np.int32)
@@ -1,19 +1,111 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from deep_translator import GoogleTranslator
+import deep_translator.google as google_backend
+import requests
 import time
 import os
+import glob
+import hashlib
+import re
+from datetime import datetime
+from common import save_csv
 
 # --- CONFIGURATION ---
 BATCH_SIZE = 50
-MEMORY_FILE = "product_translation_memory.csv"
+MAX_REQUESTS_PER_SEC = 5 # HTTP requests to Google Translate (deep_translator sends one per item)
+# Memories are Parquet dataset folders: every run appends one part file
+MEMORY_FILE = "product_translation_memory.parquet"
+LIDL_MEMORY_FILE = "lidl_translation_memory.parquet"
+MEMORY_SCHEMA = pa.schema([('id', pa.string()), ('dutch_title', pa.string()), ('english_title', pa.string())])
+
+HAS_LETTER_RE = re.compile(r'[^\W\d_]')
+
+_next_request_at = 0.0
+# One keep-alive session and translator, reused across batches and files
+_http_session = requests.Session()
+_translator = None
+
+# AH root categories never change, so their English names are fixed
+AISLE_EN = {
+    'vegetarisch-vegan-en-plantaardig': 'vegetarian-vegan-and-plant-based',
+    'groente-aardappelen': 'vegetable potatoes',
+    'fruit-verse-sappen': 'fresh fruit juices',
+    'maaltijden-salades': 'meals-salads',
+    'vlees': 'meat',
+    'vis': 'fish',
+    'vleeswaren': 'cold cuts',
+    'kaas': 'cheese',
+    'zuivel-eieren': 'dairy eggs',
+    'bakkerij': 'bakery',
+    'glutenvrij': 'gluten-free',
+    'borrel-chips-snacks': 'drinks-chips-snacks',
+    'pasta-rijst-wereldkeuken': 'pasta-rice-world cuisine',
+    'soepen-sauzen-kruiden-olie': 'soups-sauces-herbs-oil',
+    'koek-snoep-chocolade': 'cookie-candy-chocolate',
+    'ontbijtgranen-beleg': 'breakfast cereal toppings',
+    'tussendoortjes': 'snacks',
+    'diepvries': 'freezer',
+    'koffie-thee': 'coffee-tea',
+    'frisdrank-sappen-water': 'soft drinks-juices-water',
+    'bier-wijn-aperitieven': 'beer-wine aperitifs',
+    'drogisterij': 'drugstore',
+    'gezondheid-en-sport': 'health-and-sports',
+    'huishouden': 'households',
+    'koken-tafelen-vrije-tijd': 'cooking-dining-free-time'
+}
+
+class PooledRequests:
+    """
+    Stands in for the `requests` module inside deep_translator.google, which calls requests.get()
+    once per item (a fresh connection + TLS handshake each time). GETs reuse the keep-alive session,
+    and each one waits for a rate-limit slot, so the limit holds per request rather than per batch.
+    """
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def get(self, *args, **kwargs):
+        wait_for_rate_limit()
+        return _http_session.get(*args, **kwargs)
+
+google_backend.requests = PooledRequests()
+
+def get_translator():
+    """
+    One translator for the whole run, created on first use.
+    """
+    global _translator
+    if _translator is None:
+        _translator = GoogleTranslator(source='nl', target='en')
+    return _translator
+
+def wait_for_rate_limit():
+    """
+    Blocks until the next request slot, keeping requests under MAX_REQUESTS_PER_SEC.
+    """
+    global _next_request_at
+    now = time.monotonic()
+    wait = _next_request_at - now
+    _next_request_at = max(now, _next_request_at) + 1 / MAX_REQUESTS_PER_SEC
+    if wait > 0: time.sleep(wait)
+
+def translate_chunk(batch):
+    """
+    Translates one batch. Returns None if it failed (e.g. 429), so the Dutch text is never stored as a translation.
+    """
+    try:
+        return get_translator().translate_batch(batch)
+    except Exception as e:
+        print(f"   ❌ Batch Error: {e}")
+        return None
 
 def translate_text_batch(text_list):
     """
-    Translates a list of strings from Dutch to English.
+    Translates a list of strings from Dutch to English. Items whose batch failed come back as None.
     """
-    translator = GoogleTranslator(source='nl', target='en')
-    # Filter out non-strings or empty strings
-    unique_texts = list(set([t for t in text_list if isinstance(t, str) and t.strip()]))
+    # Filter out non-strings and strings without letters (sizes, SKUs), which come back unchanged anyway
+    unique_texts = list(set([t for t in text_list if isinstance(t, str) and HAS_LETTER_RE.search(t)]))
     translation_map = {}
     
     if not unique_texts:
@@ -21,83 +113,113 @@ def translate_text_batch(text_list):
 
     print(f"   Note: Found {len(unique_texts)} unique terms to translate.")
 
+    done = 0
+    failed = 0
     for i in range(0, len(unique_texts), BATCH_SIZE):
         batch = unique_texts[i : i + BATCH_SIZE]
-        try:
-            results = translator.translate_batch(batch)
-            for original, translated in zip(batch, results):
-                translation_map[original] = translated
-            
-            # Progress bar effect
-            print(f"   ... Translated {min(i + BATCH_SIZE, len(unique_texts))}/{len(unique_texts)}")
-            time.sleep(0.2)
-        except Exception as e:
-            print(f"   ❌ Batch Error: {e}")
-            for item in batch: translation_map[item] = item # Fallback
+        results = translate_chunk(batch)
+        if results is None:
+            failed += len(batch)
+            results = [None] * len(batch)
+        for original, translated in zip(batch, results):
+            translation_map[original] = translated
+
+        # Progress bar effect
+        done += len(batch)
+        print(f"   ... Translated {done}/{len(unique_texts)}")
+
+    if failed: print(f"   ⚠️ {failed} terms failed to translate; they will be retried next run.")
 
     # Map back to original list
     return [translation_map.get(t, t) if isinstance(t, str) else t for t in text_list]
 
-def load_translation_memory():
+def write_memory_part(df, memory_file):
+    """
+    Adds one zstd-compressed part file to the memory dataset (existing parts are never rewritten).
+    """
+    os.makedirs(memory_file, exist_ok=True)
+    table = pa.Table.from_pandas(df[MEMORY_SCHEMA.names], schema=MEMORY_SCHEMA, preserve_index=False)
+    # Timestamped names sort chronologically, so later parts win when deduplicating
+    part_file = os.path.join(memory_file, f"part-{datetime.now().strftime('%Y%m%d%H%M%S%f')}.parquet")
+    pq.write_table(table, part_file, compression='zstd')
+    return part_file
+
+def load_translation_memory(memory_file=MEMORY_FILE):
     """
     Loads memory and ENSURES uniqueness.
     """
-    if not os.path.exists(MEMORY_FILE):
-        print(f"🆕 No memory file found. Creating new one: {MEMORY_FILE}")
-        df = pd.DataFrame(columns=['id', 'dutch_title', 'english_title'])
-        df.to_csv(MEMORY_FILE, index=False)
-        return {}
+    if not os.path.exists(memory_file):
+        legacy_csv = memory_file.replace(".parquet", ".csv")
+        if not os.path.exists(legacy_csv):
+            print(f"🆕 No memory file found. It will be created at: {memory_file}")
+            return pd.DataFrame(columns=['dutch_title', 'english_title'], index=pd.Index([], name='id'), dtype="string[pyarrow]")
+        # One-off migration from the old CSV memory
+        print(f"🔁 Migrating {legacy_csv} to {memory_file}...")
+        write_memory_part(pd.read_csv(legacy_csv, dtype=str), memory_file)
     
-    print(f"🧠 Loading Translation Memory from {MEMORY_FILE}...")
-    # Force ID to string
-    df = pd.read_csv(MEMORY_FILE, dtype={'id': str})
+    print(f"🧠 Loading Translation Memory from {memory_file}...")
+    # Arrow-backed strings: contiguous buffers instead of one Python object per cell
+    df = pd.read_parquet(memory_file, dtype_backend='pyarrow')
     
     # CRITICAL FIX: Drop duplicates immediately upon loading
     initial_len = len(df)
     df = df.drop_duplicates(subset=['id'], keep='last')
     if len(df) < initial_len:
         print(f"   🧹 Cleaned {initial_len - len(df)} duplicate IDs from memory file.")
-        # Optional: Save clean version back immediately
-        df.to_csv(MEMORY_FILE, index=False)
+        # Compact: one clean part replaces all the old ones
+        old_parts = glob.glob(os.path.join(memory_file, "*.parquet"))
+        write_memory_part(df, memory_file)
+        for part_file in old_parts: os.remove(part_file)
     
-    # Create lookup dictionary
-    memory_dict = pd.Series(df.english_title.values, index=df.id).to_dict()
-    print(f"   ↳ Loaded {len(memory_dict)} unique translated items.")
-    return memory_dict
+    # Indexed by id; isin/map use its hash index directly
+    memory = df.set_index('id')
+    print(f"   ↳ Loaded {len(memory)} unique translated items.")
+    return memory
 
-def update_memory_safely(new_entries_df):
+def update_memory_safely(new_entries_df, memory_file=MEMORY_FILE):
     """
-    Updates the CSV file while strictly enforcing uniqueness.
+    Appends new entries to the memory as a new part file. Duplicate IDs are compacted away on the next load.
     """
     if new_entries_df.empty: return
 
-    # 1. Load existing file
-    if os.path.exists(MEMORY_FILE):
-        existing_df = pd.read_csv(MEMORY_FILE, dtype={'id': str})
-    else:
-        existing_df = pd.DataFrame(columns=['id', 'dutch_title', 'english_title'])
-
-    # 2. Combine Old + New
-    combined_df = pd.concat([existing_df, new_entries_df], ignore_index=True)
+    write_memory_part(new_entries_df, memory_file)
+    print(f"💾 Updated Memory: Appended {len(new_entries_df)} new items to {memory_file}.")
 
-    # 3. Deduplicate (Keep LAST aka newest entry if there's a conflict)
-    deduped_df = combined_df.drop_duplicates(subset=['id'], keep='last')
-
-    # 4. Save (Overwrite the file with the clean version)
-    deduped_df.to_csv(MEMORY_FILE, index=False)
-    print(f"💾 Updated Memory: File now contains {len(deduped_df)} unique items (Added {len(new_entries_df)} new).")
+def title_key(title):
+    """
+    Stable memory key for products without a stable ID (md5 of the normalized title).
+    """
+    normalized = " ".join(str(title).lower().split())
+    return hashlib.md5(normalized.encode("utf-8")).hexdigest()
 
 def process_lidl(filename):
     print(f"\n🚜 Processing Lidl File: {filename}...")
     try:
         df = pd.read_csv(filename)
-        # Lidl doesn't use the ID memory because IDs aren't stable across weeks
+        # Lidl IDs aren't stable across weeks, so the memory is keyed by title instead
         if 'title' in df.columns:
-            print("   Translating 'title'...")
-            df['title_eng'] = translate_text_batch(df['title'].tolist())
+            memory_series = load_translation_memory(LIDL_MEMORY_FILE)['english_title']
+            keys = df['title'].map(title_key)
+
+            is_new = ~keys.isin(memory_series.index) & df['title'].notna()
+            unique_new = pd.DataFrame({'id': keys[is_new], 'title': df.loc[is_new, 'title']}).drop_duplicates(subset=['id'])
+            print(f"   New Titles to Translate: {len(unique_new)}")
+
+            if not unique_new.empty:
+                titles_nl = unique_new['title'].tolist()
+                titles_en = translate_text_batch(titles_nl)
+                # Failed translations (None) stay out of the memory so the next run retries them
+                update_memory_safely(pd.DataFrame({
+                    'id': unique_new['id'],
+                    'dutch_title': titles_nl,
+                    'english_title': titles_en
+                }).dropna(subset=['english_title']), LIDL_MEMORY_FILE)
+                memory_series = pd.concat([memory_series, pd.Series(titles_en, index=unique_new['id']).dropna()])
+
+            df['title_eng'] = keys.map(memory_series).fillna(df['title'])
         
         output_name = filename.replace(".csv", "_translated.csv")
-        df.to_csv(output_name, index=False)
+        save_csv(df, output_name)
         print(f"✅ Saved to {output_name}")
     except FileNotFoundError: print(f"❌ File not found: {filename}")
 
@@ -105,32 +227,30 @@ def process_ah_summary(filename):
     print(f"\n🚜 Processing AH Summary: {filename}...")
     try:
         df = pd.read_csv(filename)
-        # Summary categories are small, just translate on the fly
         if 'scraped_aisle' in df.columns:
-            df['aisle_eng'] = translate_text_batch(df['scraped_aisle'].tolist())
+            df['aisle_eng'] = df['scraped_aisle'].map(AISLE_EN).fillna(df['scraped_aisle'])
         
         output_name = filename.replace(".csv", "_translated.csv")
-        df.to_csv(output_name, index=False)
+        save_csv(df, output_name)
         print(f"✅ Saved to {output_name}")
     except FileNotFoundError: print(f"❌ File not found: {filename}")
 
 def process_ah_export(filename):
     print(f"\n🚀 Processing AH Export: {filename}")
     try:
-        df_daily = pd.read_csv(filename)
+        # pyarrow's multithreaded parser; ID read as string up front
+        df_daily = pd.read_csv(filename, engine='pyarrow', dtype={'id': str, 'scraped_at': str})
     except FileNotFoundError:
         print("❌ Input file not found.")
         return
 
     # 1. Load Memory (Cleaned)
-    memory_map = load_translation_memory()
-    
-    # Ensure ID is string
-    df_daily['id'] = df_daily['id'].astype(str)
+    memory = load_translation_memory()
+    memory_series = memory['english_title']
     
     # 2. Identify Missing Translations
-    # Only look for IDs that are NOT in our memory map
-    is_new = ~df_daily['id'].isin(memory_map.keys())
+    # Only look for IDs that are NOT in our memory
+    is_new = ~df_daily['id'].isin(memory_series.index)
     new_products = df_daily[is_new].copy()
     
     print(f"   New Items to Translate: {len(new_products)}")
@@ -140,32 +260,37 @@ def process_ah_export(filename):
         # Deduplicate within the new batch itself (e.g. if 'Milk' appears twice in today's file)
         unique_new = new_products[['id', 'title']].drop_duplicates(subset=['id'])
         
-        titles_nl = unique_new['title'].tolist()
-        titles_en = translate_text_batch(titles_nl)
+        # A new ID with a Dutch title we already translated (e.g. a relisted product) reuses it
+        known_titles = memory.drop_duplicates(subset=['dutch_title'], keep='last').set_index('dutch_title')['english_title']
+        titles_en = unique_new['title'].map(known_titles).astype(object)
+        missing = titles_en.isna()
+        print(f"   ↳ Reused {(~missing).sum()} translations by title, sending {missing.sum()} to the translator.")
+        if missing.any():
+            titles_en[missing] = translate_text_batch(unique_new.loc[missing, 'title'].tolist())
+        titles_en = titles_en.tolist()
         
         # Prepare new memory dataframe
         new_memory = pd.DataFrame({
             'id': unique_new['id'],
-            'dutch_title': titles_nl,
+            'dutch_title': unique_new['title'],
             'english_title': titles_en
         })
         
-        # Save safely
-        update_memory_safely(new_memory)
+        # Save safely; failed translations (None) stay out so the next run retries them
+        update_memory_safely(new_memory.dropna(subset=['english_title']))
         
-        # Update local map for this run
-        new_map = pd.Series(titles_en, index=unique_new['id']).to_dict()
-        memory_map.update(new_map)
+        # Update local memory for this run
+        memory_series = pd.concat([memory_series, pd.Series(titles_en, index=unique_new['id']).dropna()])
     
     # 4. Map Translations to Main Dataframe
-    df_daily['title_eng'] = df_daily['id'].map(memory_map).fillna(df_daily['title'])
+    df_daily['title_eng'] = df_daily['id'].map(memory_series).fillna(df_daily['title'])
     
-    # 5. Translate Categories (Optional, usually small enough to just run)
+    # 5. Translate Categories (fixed set, no network needed)
     if 'scraped_aisle' in df_daily.columns:
-        df_daily['aisle_eng'] = translate_text_batch(df_daily['scraped_aisle'].tolist())
+        df_daily['aisle_eng'] = df_daily['scraped_aisle'].map(AISLE_EN).fillna(df_daily['scraped_aisle'])
 
     output_file = filename.replace(".csv", "_translated.csv")
-    df_daily.to_csv(output_file, index=False)
+    save_csv(df_daily, output_file)
     print(f"✅ Finished! Saved to {output_file}")
 
 def run_translation_pipeline(lidl_file=None, ah_export_file=None, ah_summary_file=None):
@@ -1,9 +1,10 @@
 from curl_cffi import requests
 from lxml import html
-import json
+import orjson
 import pandas as pd
-import html as html_parser
+import numpy as np
 from datetime import datetime
+from common import save_csv, compute_discount
 
 def scrape_lidl_final_refined():
     base_url = "https://www.lidl.nl/c/aanbiedingen/a10008785"
@@ -11,6 +12,7 @@ def scrape_lidl_final_refined():
     session = requests.Session(impersonate="chrome110")
     
     offers_data = []
+    scraped_at = datetime.now().strftime("%Y-%m-%d")
     
     try:
         print("   ⏳ Requesting page...", end="")
@@ -21,16 +23,16 @@ def scrape_lidl_final_refined():
         print(" ✅ Done.")
 
         tree = html.fromstring(response.content)
-        grid_nodes = tree.xpath('//*[@data-grid-data]/@data-grid-data')
+        grid_nodes = tree.xpath('//*[@data-grid-data]')
         
         if not grid_nodes:
             print("   ⚠️ No data found.")
             return None
 
-        for raw_json in grid_nodes:
+        for node in grid_nodes:
             try:
-                clean_json = html_parser.unescape(raw_json)
-                data = json.loads(clean_json)
+                # lxml already decodes entity references in attribute values
+                data = orjson.loads(node.get('data-grid-data'))
                 if isinstance(data, dict): data = [data]
                 
                 for p in data:
@@ -62,21 +64,6 @@ def scrape_lidl_final_refined():
                         raw_old = std_price_obj.get('oldPrice')
                         if not raw_current: raw_current = p.get('priceLabel')
 
-                    try:
-                        final_price = float(raw_current) if raw_current else 0.0
-                        old_price = float(raw_old) if raw_old else 0.0
-                    except ValueError: continue
-
-                    if old_price == 0: old_price = final_price
-
-                    # Discount Calc
-                    discount_pct = 0
-                    if old_price > 0 and old_price != final_price:
-                        try:
-                            val = 100 * (old_price - final_price) / old_price
-                            discount_pct = int(round(val))
-                        except ZeroDivisionError: discount_pct = 0
-
                     if "Lidl Plus" not in discount_label:
                         ribbons = p.get('ribbons')
                         if ribbons and isinstance(ribbons, list) and len(ribbons) > 0:
@@ -84,16 +71,16 @@ def scrape_lidl_final_refined():
                         elif p.get('merchandising', {}).get('text'):
                              discount_label = p.get('merchandising', {}).get('text')
 
+                    # Prices stay raw here; casting + discount math runs vectorized below
                     item = {
                         "title": p.get('fullTitle'),
-                        "price": final_price,
-                        "old_price": old_price,
-                        "discount_percent": discount_pct,
+                        "price": raw_current,
+                        "old_price": raw_old,
                         "discount_label": discount_label,
                         "deal_type": source_type,
                         "unit": p.get('price', {}).get('packaging', {}).get('text') or p.get('price', {}).get('unitSize'),
                         "url": f"https://www.lidl.nl{p.get('canonicalUrl', '')}",
-                        "scraped_at": datetime.now().strftime("%Y-%m-%d")
+                        "scraped_at": scraped_at
                     }
                     offers_data.append(item)
             except Exception: continue
@@ -104,9 +91,23 @@ def scrape_lidl_final_refined():
 
     if offers_data:
         df = pd.DataFrame(offers_data)
+
+        # --- PRICE CASTING (vectorized) ---
+        final_price = pd.to_numeric(df['price'], errors='coerce')
+        old_price = pd.to_numeric(df['old_price'], errors='coerce')
+        # A price that was given but isn't a number means the row is unusable
+        unparseable = (final_price.isna() & df['price'].fillna(0).astype(bool)) | (old_price.isna() & df['old_price'].fillna(0).astype(bool))
+        df = df[~unparseable]
+        final_price = final_price[~unparseable].fillna(0.0).to_numpy()
+        old_price = old_price[~unparseable].fillna(0.0).to_numpy()
+        old_price = np.where(old_price == 0, final_price, old_price)
+        discount_pct = compute_discount(final_price, old_price)
+
+        df = df.assign(price=final_price, old_price=old_price)
+        df.insert(3, "discount_percent", discount_pct)
         df = df.drop_duplicates(subset=['title'])
         filename = f"lidl_offers_{datetime.now().strftime('%Y%m%d')}.csv"
-        df.to_csv(filename, index=False)
+        save_csv(df, filename)
         print(f"✅ Lidl Scraper Finished: {filename} ({len(df)} offers)")
         return filename
     else:
@@ -1,175 +1,318 @@
 import pandas as pd
+import numpy as np
 import gspread
-from rapidfuzz import process, fuzz
+from rapidfuzz import process, fuzz, utils
+from collections import defaultdict
 import time
+import json
+import os
+import hashlib
+import functools
+import threading
 
 # --- CONFIGURATION ---
 SHEET_URL = "https://docs.google.com/spreadsheets/d/1tCg-sqNG3HWTDpdDuNIpVoIuImWU5rqMdelr9rxEu8E/edit"
 SHEET_TAB_NAME = "Raw"
-MEMORY_FILE = "product_translation_memory.csv"
+MEMORY_FILE = "product_translation_memory.parquet"
 CREDENTIALS_FILE = "grocery_tracker.json"
 MATCH_THRESHOLD = 85
+PREFILTER_CUTOFF = MATCH_THRESHOLD - 5  # token_set_ratio shortlist cutoff
+RERANK_TOP = 10  # shortlist size re-scored with WRatio
+FUZZY_CACHE_FILE = "fuzzy_match_cache.json"
+WRITE_NO_MATCH = True  # write "No match found" into empty ids cells of unmatched rows
+SHEET_COLUMNS = ["store", "product_original", "id", "ids"]
 
-def authenticate_google_sheets():
-    try:
-        gc = gspread.service_account(filename=CREDENTIALS_FILE)
-        sh = gc.open_by_url(SHEET_URL)
-        return sh.worksheet(SHEET_TAB_NAME)
-    except Exception as e:
-        print(f"❌ Auth Failed: {e}")
-        return None
+_worksheet = None
+_worksheet_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def get_client():
+    # Failed attempts raise, so they are not cached and the next call retries
+    return gspread.service_account(filename=CREDENTIALS_FILE)
+
+def get_worksheet():
+    """Authenticates once per process; later calls reuse the same worksheet"""
+    global _worksheet
+    with _worksheet_lock:
+        if _worksheet is None:
+            try:
+                sh = get_client().open_by_url(SHEET_URL)
+                _worksheet = sh.worksheet(SHEET_TAB_NAME)
+            except Exception as e:
+                print(f"❌ Auth Failed: {e}")
+        return _worksheet
 
 def load_database():
     try:
-        df = pd.read_csv(MEMORY_FILE, dtype={'id': str})
+        df = pd.read_parquet(MEMORY_FILE, columns=['id', 'dutch_title'], dtype_backend='pyarrow')
+        # Products AH returned without a title can't be matched (and would break default_process)
+        df = df.dropna(subset=['dutch_title'])
+        df = df[df['dutch_title'].str.strip() != ""]
         print(f"🧠 Database Loaded: {len(df)} products.")
         return df
     except FileNotFoundError:
         print(f"❌ Could not find {MEMORY_FILE}")
         return None
 
-def find_best_matches(query, choices_dict, limit=3):
-    results = process.extract(
-        query, 
-        choices_dict.keys(), 
-        scorer=fuzz.WRatio, 
-        limit=limit
-    )
-    valid_matches = []
-    for match_name, score, _ in results:
-        if score >= MATCH_THRESHOLD:
-            prod_id = choices_dict[match_name]
-            valid_matches.append((prod_id, match_name, score))
-    return valid_matches
+def pair_key(title, product_id):
+    """Short stable hash of one (title, id) DB entry"""
+    return hashlib.blake2b(f"{title}\0{product_id}".encode("utf-8"), digest_size=8).hexdigest()
+
+def load_fuzzy_cache(db_choices, pair_keys):
+    """
+    Fuzzy results from earlier runs ({name: [(id, name, score), ...]}) plus the DB positions of the titles
+    added since they were computed. Entries pointing at a title that is gone or now has another id are dropped.
+    """
+    try:
+        with open(FUZZY_CACHE_FILE, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}, []
+    if "pairs" not in cache: return {}, []
+    
+    seen = set(cache["pairs"])
+    new_idx = [j for j, key in enumerate(pair_keys) if key not in seen]
+    matches = {}
+    for name, cached in cache["matches"].items():
+        if all(db_choices.get(title) == product_id for product_id, title, _ in cached):
+            matches[name] = [tuple(m) for m in cached]
+    return matches, new_idx
+
+def save_fuzzy_cache(results, pair_keys):
+    # Write to a temp file first so a crash never leaves a half-written cache
+    tmp_file = FUZZY_CACHE_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump({"pairs": pair_keys, "matches": results}, f, ensure_ascii=False)
+    os.replace(tmp_file, FUZZY_CACHE_FILE)
+
+def prefix_keys(processed_name, tokens=1):
+    """First 3 chars of the first token(s) of an already normalized name"""
+    return {token[:3] for token in processed_name.split()[:tokens]}
+
+def build_prefix_buckets(processed_choices):
+    # {prefix: [DB positions]}, positions stay ascending so ties keep DB order
+    buckets = defaultdict(list)
+    for j, name in enumerate(processed_choices):
+        for key in prefix_keys(name): buckets[key].append(j)
+    return buckets
+
+def score_against(queries, processed_choices, choice_names, choice_ids, candidate_idx, limit):
+    """
+    Scores the (normalized) queries against processed_choices[candidate_idx].
+    Returns {query: [(id, name, score), ...]} best first, only for queries with a match >= MATCH_THRESHOLD.
+    """
+    subset = [processed_choices[j] for j in candidate_idx]
+    # Cheap pass: token_set_ratio with a looser cutoff picks the shortlist for every query in one cdist call.
+    # Inputs are already normalized, so no processor; workers=-1 spreads the rows over all cores
+    scores = process.cdist(queries, subset, scorer=fuzz.token_set_ratio, processor=None, score_cutoff=PREFILTER_CUTOFF, dtype=np.float32, workers=-1)
+    
+    results = {}
+    for query, row in zip(queries, scores):
+        candidates = np.flatnonzero(row)
+        if not len(candidates): continue
+        shortlist = candidates[np.lexsort((candidates, -row[candidates]))][:RERANK_TOP]
+        # Re-rank the shortlist with WRatio, which decides the final score
+        reranked = [(fuzz.WRatio(query, subset[j], processor=None, score_cutoff=MATCH_THRESHOLD), j) for j in shortlist]
+        # Best first; ties resolve in DB order, like extract
+        top = sorted((-score, j) for score, j in reranked if score)[:limit]
+        if top: results[query] = [(choice_ids[candidate_idx[j]], choice_names[candidate_idx[j]], -score) for score, j in top]
+    return results
+
+def find_best_matches(queries, processed_choices, choice_names, choice_ids, limit=3):
+    """
+    Returns {query: [(id, name, score), ...]} best first, only matches >= MATCH_THRESHOLD.
+    processed_choices are the DB titles already run through utils.default_process.
+    Each query is first scored against the DB titles sharing a prefix with its first two words;
+    only queries with no match there are scored against the full DB.
+    """
+    if not queries or not choice_names: return {}
+    # Lowercase/strip every string once here instead of inside every comparison
+    processed_queries = {query: utils.default_process(query) for query in queries}
+    unique_processed = set(processed_queries.values())
+    buckets = build_prefix_buckets(processed_choices)
+    
+    # Queries with the same prefixes share one candidate list (and one cdist call)
+    groups = defaultdict(list)
+    for processed in unique_processed:
+        groups[frozenset(prefix_keys(processed, tokens=2))].append(processed)
+    
+    results = {}
+    for keys, group in groups.items():
+        candidate_idx = sorted(set().union(*(buckets.get(key, ()) for key in keys)))
+        if candidate_idx: results.update(score_against(group, processed_choices, choice_names, choice_ids, candidate_idx, limit))
+    
+    # Fall back to the full list for anything the buckets couldn't answer
+    leftovers = [processed for processed in unique_processed if processed not in results]
+    if leftovers: results.update(score_against(leftovers, processed_choices, choice_names, choice_ids, range(len(choice_names)), limit))
+    
+    return {query: results.get(processed, []) for query, processed in processed_queries.items()}
+
+def id_updates(id_cell, ids_cell, adjacent, found_id, ids_str):
+    """Sheet updates for one row's id/ids cells; a single range when the columns sit side by side"""
+    if adjacent:
+        return [{'range': f"{id_cell}:{ids_cell}", 'values': [[found_id, ids_str]]}]
+    return [{'range': id_cell, 'values': [[found_id]]}, {'range': ids_cell, 'values': [[ids_str]]}]
 
 def run_mapping_pipeline():
     print("🚀 Starting Smart Mapping Pipeline...")
     
     # 1. Setup
-    worksheet = authenticate_google_sheets()
+    worksheet = get_worksheet()
     if not worksheet: return
     
     db_df = load_database()
     if db_df is None: return
 
     # Database Lookup: {Dutch Title: ID}
-    db_choices = pd.Series(db_df.id.values, index=db_df.dutch_title).to_dict()
+    db_choices = dict(zip(db_df['dutch_title'].to_numpy(), db_df['id'].to_numpy()))
     
-    # 2. Get Sheet Data
+    # 2. Get Sheet Data (header once, then only the columns we use)
     print("📥 Fetching Google Sheet data...")
-    all_records = worksheet.get_all_records()
-    df_sheet = pd.DataFrame(all_records)
+    header = worksheet.row_values(1)
     
     # Validation
-    if 'id' not in df_sheet.columns:
+    if 'id' not in header:
         print("   Creating columns...")
         worksheet.add_cols(2)
-        df_sheet['id'] = ""
-        df_sheet['ids'] = ""
+        header += ['id', 'ids']
+    
+    # Sheet column letter per needed column, e.g. {'id': 'G'}
+    col_letters = {name: gspread.utils.rowcol_to_a1(1, header.index(name) + 1)[:-1] for name in SHEET_COLUMNS if name in header}
+    ranges = worksheet.batch_get([f"{letter}2:{letter}" for letter in col_letters.values()])
+    # Empty cells come back as [] and trailing empty rows are dropped, so pad every column to the same length
+    columns = {name: [row[0] if row else "" for row in values] for name, values in zip(col_letters, ranges)}
+    n_rows = max(map(len, columns.values()), default=0)
+    df_sheet = pd.DataFrame({name: values + [""] * (n_rows - len(values)) for name, values in columns.items()})
 
     # --- STRATEGY: LEARN FROM SHEET HISTORY ---
     # Build a lookup of product_original -> (id, ids) from rows that are ALREADY mapped
     print("   Building internal history...")
-    known_mappings = {}
+    # Column-wise cleanup once, instead of str(...).strip() per row
+    id_str = df_sheet['id'].astype(str).str.strip()
+    names = df_sheet['product_original'].astype(str).str.strip()
     
-    # Filter for rows that HAVE an ID
-    mapped_rows = df_sheet[df_sheet['id'].astype(str).str.strip() != ""]
+    # Rows that HAVE an ID (and a name) teach us a mapping
+    mapped_mask = (id_str != "") & (names != "")
+    mapped_ids = df_sheet.loc[mapped_mask, 'ids'].astype(str).str.strip()
+    known_mappings = dict(zip(names[mapped_mask], zip(id_str[mapped_mask], mapped_ids)))
     
-    for _, row in mapped_rows.iterrows():
-        p_name = str(row['product_original']).strip()
-        p_id = str(row['id']).strip()
-        p_ids = str(row['ids']).strip()
-        
-        # Store if valid
-        if p_name and p_id:
-            known_mappings[p_name] = (p_id, p_ids)
-            
     print(f"   ↳ Learned {len(known_mappings)} exact mappings from history.")
 
     # 3. Identify Rows to Process
     # Criteria: Store is AH AND id is empty
-    to_process_indices = []
+    stores = df_sheet['store'].astype(str) if 'store' in df_sheet.columns else pd.Series("", index=df_sheet.index)
+    todo_mask = stores.str.lower().str.contains('albert_heijn', regex=False) & (id_str == "")
+    to_process_indices = np.flatnonzero(todo_mask.to_numpy())
     
-    for index, row in df_sheet.iterrows():
-        store = str(row.get('store', '')).lower()
-        existing_id = str(row.get('id', '')).strip()
-        
-        # NOTE: I assumed you want 'in' AH. If you meant 'not in', change this back!
-        if 'albert_heijn' in store and not existing_id:
-            to_process_indices.append(index)
-            
     print(f"🔍 Found {len(to_process_indices)} unmapped AH purchases.")
     
     if len(to_process_indices) == 0:
         print("✅ No new rows to map.")
         return
 
-    # 4. Processing Loop
+    # 4. Fuzzy-match every name the history can't answer, in one batch
+    choice_names = list(db_choices.keys())
+    choice_ids = list(db_choices.values())
+    processed_choices = [utils.default_process(name) for name in choice_names]
+    pair_keys = [pair_key(title, product_id) for title, product_id in zip(choice_names, choice_ids)]
+    fuzzy_cache, new_idx = load_fuzzy_cache(db_choices, pair_keys)
+    # Recurring purchases repeat the same name, so each distinct name is matched once
+    unique_names = sorted({name for name in names.iloc[to_process_indices] if name and name not in known_mappings})
+    
+    # Exact tier: names equal to a DB title after normalization need no fuzzy matching.
+    # First title wins, like the DB-order tie-breaking in find_best_matches
+    exact_norm = {}
+    for j, processed in enumerate(processed_choices):
+        if processed: exact_norm.setdefault(processed, j)
+    exact_hits = {}
+    for name in unique_names:
+        j = exact_norm.get(utils.default_process(name))
+        if j is not None: exact_hits[name] = [(choice_ids[j], choice_names[j], 100.0)]
+    
+    queries = [name for name in unique_names if name not in exact_hits and name not in fuzzy_cache]
+    cached = [name for name in unique_names if name not in exact_hits and name in fuzzy_cache]
+    print(f"   ↳ {len(unique_names)} distinct names: {len(exact_hits)} exact, {len(cached)} cached from earlier runs, {len(queries)} to fuzzy-match.")
+    
+    # Cached names only need scoring against the titles added since they were cached
+    if cached and new_idx:
+        print(f"   ↳ Checking cached names against {len(new_idx)} new DB titles...")
+        new_matches = find_best_matches(cached, [processed_choices[j] for j in new_idx], [choice_names[j] for j in new_idx], [choice_ids[j] for j in new_idx])
+        position = {title: j for j, title in enumerate(choice_names)}
+        for name, matches in new_matches.items():
+            # Best first; ties resolve in DB order, like find_best_matches
+            if matches: fuzzy_cache[name] = sorted(fuzzy_cache[name] + matches, key=lambda m: (-m[2], position[m[1]]))[:3]
+    
+    fuzzy_results = {**fuzzy_cache, **exact_hits, **find_best_matches(queries, processed_choices, choice_names, choice_ids)}
+    # Only this run's names are kept: every saved entry has now been scored against the whole current DB
+    fuzzy_results = {name: fuzzy_results[name] for name in unique_names}
+    save_fuzzy_cache(fuzzy_results, pair_keys)
+    
+    # {name: (best_id, ids_str, best_score)} for every distinct name with a match
+    results_by_name = {}
+    for name in unique_names:
+        matches = fuzzy_results[name]
+        if matches: results_by_name[name] = (matches[0][0], "; ".join([f"{m[0]} ({int(m[2])}%)" for m in matches]), int(matches[0][2]))
+
+    # 5. Processing Loop
     updates = []
     
-    # Pre-calculate column indices (0-based in df, 1-based in Sheet)
-    col_id_idx = df_sheet.columns.get_loc("id") + 1
-    col_ids_idx = df_sheet.columns.get_loc("ids") + 1
+    # Pre-calculate column indices (1-based in Sheet)
+    col_id_idx = header.index("id") + 1
+    col_ids_idx = header.index("ids") + 1
+    adjacent = col_ids_idx == col_id_idx + 1
+    # A1 cells for every row we may write (sheet row = idx + 2), reusing the column letters from step 2
+    id_letter, ids_letter = col_letters['id'], col_letters['ids']
+    id_cells = [f"{id_letter}{idx + 2}" for idx in to_process_indices]
+    ids_cells = [f"{ids_letter}{idx + 2}" for idx in to_process_indices]
+    names_arr = names.to_numpy()
+    ids_arr = df_sheet['ids'].astype(str).str.strip().to_numpy()
+    # One line per row, printed together after the loop instead of a print per row
+    log = []
 
-    for idx in to_process_indices:
-        sheet_row_num = idx + 2 
-        product_name = str(df_sheet.at[idx, 'product_original']).strip()
+    for idx, id_cell, ids_cell in zip(to_process_indices, id_cells, ids_cells):
+        product_name = names_arr[idx]
         
         if not product_name: continue
 
-        print(f"   Processing: '{product_name}'...", end="")
-        
         # --- CHECK 1: EXACT MATCH IN HISTORY ---
         if product_name in known_mappings:
             # We found it in our own sheet history! Copy the ID.
             found_id, found_ids_str = known_mappings[product_name]
-            print(f" ⚡ HISTORY MATCH: {found_id}")
+            log.append(f"   Processing: '{product_name}'... ⚡ HISTORY MATCH: {found_id}")
             
-            updates.append({
-                'range': gspread.utils.rowcol_to_a1(sheet_row_num, col_id_idx),
-                'values': [[str(found_id)]]
-            })
-            updates.append({
-                'range': gspread.utils.rowcol_to_a1(sheet_row_num, col_ids_idx),
-                'values': [[str(found_ids_str)]]
-            })
+            updates += id_updates(id_cell, ids_cell, adjacent, str(found_id), str(found_ids_str))
             continue # Skip to next row
 
-        # --- CHECK 2: FUZZY MATCH DB ---
-        # If not in history, ask the database
-        matches = find_best_matches(product_name, db_choices)
-        
-        if matches:
-            best_id, best_name, best_score = matches[0]
-            ids_str = "; ".join([f"{m[0]} ({int(m[2])}%)" for m in matches])
+        # --- CHECK 2: EXACT / FUZZY MATCH DB ---
+        # If not in history, use the database scores computed above
+        if product_name in results_by_name:
+            best_id, ids_str, best_score = results_by_name[product_name]
             
-            print(f" 🤖 FUZZY MATCH: {best_id} ({int(best_score)}%)")
+            tier = "🎯 EXACT MATCH" if product_name in exact_hits else "🤖 FUZZY MATCH"
+            log.append(f"   Processing: '{product_name}'... {tier}: {best_id} ({best_score}%)")
             
-            updates.append({
-                'range': gspread.utils.rowcol_to_a1(sheet_row_num, col_id_idx),
-                'values': [[str(best_id)]]
-            })
-            updates.append({
-                'range': gspread.utils.rowcol_to_a1(sheet_row_num, col_ids_idx),
-                'values': [[ids_str]]
-            })
+            updates += id_updates(id_cell, ids_cell, adjacent, str(best_id), ids_str)
             
             # OPTIONAL: Add this new find to known_mappings so subsequent rows
             # in THIS batch use it immediately without recalculating fuzzy match
             known_mappings[product_name] = (best_id, ids_str)
             
         else:
-            print(f" ⚠️ No match > {MATCH_THRESHOLD}%")
-            updates.append({
-                'range': gspread.utils.rowcol_to_a1(sheet_row_num, col_ids_idx),
-                'values': [['No match found']]
-            })
+            log.append(f"   Processing: '{product_name}'... ⚠️ No match > {MATCH_THRESHOLD}%")
+            # Only mark empty cells; rows already marked (or holding notes) are left alone
+            if WRITE_NO_MATCH and not ids_arr[idx]:
+                updates.append({
+                    'range': ids_cell,
+                    'values': [['No match found']]
+                })
+
+    if log: print("\n".join(log))
 
-    # 5. Batch Update
+    # 6. Batch Update
     if updates:
         print(f"💾 Saving {len(updates)} changes to Google Sheets...")
         try:
-            worksheet.batch_update(updates)
+            worksheet.batch_update(updates, value_input_option='RAW')
             print("🎉 Success!")
         except Exception as e:
             print(f"❌ Batch Update Failed: {e}")
@@ -1,6 +1,7 @@
 import sys
 import time
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Import modules
 try:
@@ -10,7 +11,7 @@ try:
     import map_purchases
 except ImportError as e:
     print(f"❌ Error: {e}")
-    print("Ensure lidl.py, albert_heijn.py, file_trans.py, and map_purchases.py are in the same folder.")
+    print("Ensure common.py, lidl.py, albert_heijn.py, file_trans.py, and map_purchases.py are in the same folder.")
     sys.exit(1)
 
 def main():
@@ -21,22 +22,25 @@ def main():
     print(f"   🚀 DAILY DATA PIPELINE STARTED: {today_str}")
     print(f"==================================================")
 
-    # --- STEP 1: LIDL SCRAPING ---
-    print("\n[1/4] Scraping Lidl...")
+    # --- STEPS 1 & 2: LIDL + ALBERT HEIJN SCRAPING ---
+    # Both scrapers only wait on the network and share nothing, so run them side by side
+    print("\n[1-2/4] Scraping Lidl and Albert Heijn...")
     lidl_file = None
-    try:
-        lidl_file = lidl.scrape_lidl_final_refined()
-    except Exception as e:
-        print(f"❌ Lidl Failed: {e}")
-
-    # --- STEP 2: ALBERT HEIJN SCRAPING ---
-    print("\n[2/4] Scraping Albert Heijn...")
     ah_export_file = None
     ah_summary_file = None
-    try:
-        ah_export_file, ah_summary_file = albert_heijn.scrape_ah_final()
-    except Exception as e:
-        print(f"❌ AH Failed: {e}")
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_lidl = ex.submit(lidl.scrape_lidl_final_refined)
+        f_ah = ex.submit(albert_heijn.scrape_ah_final)
+
+        try:
+            lidl_file = f_lidl.result()
+        except Exception as e:
+            print(f"❌ Lidl Failed: {e}")
+
+        try:
+            ah_export_file, ah_summary_file = f_ah.result()
+        except Exception as e:
+            print(f"❌ AH Failed: {e}")
 
     # --- STEP 3: TRANSLATION ---
     print("\n[3/4] Translating Data...")